@@ -14,6 +14,9 @@ import socket
 import signal
 import multiprocessing
 import errno
+import fnmatch
+import sqlite3
+import ssl
 
 """
 An easy wrapper for the native ftplib in python.
@@ -160,20 +163,386 @@ class FtpEntry(object):
 
     def __str__(self):
         return os.path.join(self.remote_dir, self.name)
-    
+
+
+class TransferReport(object):
+    """
+    Object holding the result of a batch of downloads, see FTP.download_files.
+    """
+    def __init__(self):
+        self.succeeded = []
+        self.failed = []
+        self.skipped = []
+        self.number_of_bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def files_per_second(self):
+        """
+        The number of files handled, downloaded or skipped, per second.
+        """
+        if self.seconds <= 0:
+            return 0.0
+        return (len(self.succeeded) + len(self.skipped)) / self.seconds
+
+    def __str__(self):
+        return "%i downloaded, %i skipped, %i failed, %i bytes in %.2f second(s), %.2f file(s)/second."%(
+            len(self.succeeded), len(self.skipped), len(self.failed), self.number_of_bytes, self.seconds, self.files_per_second)
+
+
+if hasattr(ftplib, "FTP_TLS"):
+    class _FTP_TLS(ftplib.FTP_TLS):
+        """
+        ftplib.FTP_TLS, with the wrapping of the data connections in a method of its own,
+        so that it can be used for data connections not made by ntransfercmd.
+
+        NOTE: Each protected data connection does a full TLS handshake. The ssl module in
+        python 2 can not resume the TLS session of the control connection. Servers that
+        require session reuse on the data connections, e.g. vsftpd with its default
+        require_ssl_reuse=YES, refuse the data connections, so listing and downloading
+        fail with PROT P. Use tls_protect_data=False (PROT C) against such servers, if
+        clear text data is acceptable, or turn the requirement off on the server.
+        """
+        def wrap_data_socket(self, conn):
+            """
+            Wraps the data connection in TLS, if the data channel is protected (PROT P).
+            """
+            if not self._prot_p:
+                return conn
+            return self.context.wrap_socket(conn, server_hostname=self.host)
+
+        def ntransfercmd(self, cmd, rest=None):
+            conn, size = ftplib.FTP.ntransfercmd(self, cmd, rest)
+            return self.wrap_data_socket(conn), size
+
+
+class _SqliteFile(object):
+    """
+    Internal base class for the things stored in a local sqlite file.
+
+    The file may be shared by several processes. Every process gets its own
+    connection (sqlite connections can not be shared across a fork), and
+    writers wait for each other for up to timeout_seconds.
+    """
+    SCHEMA = ()
+
+    def __init__(self, filename, timeout_seconds = 30):
+        self.filename = filename
+        self._timeout_seconds = timeout_seconds
+        self._connection = None
+        self._connection_pid = None
+
+    def _connect(self):
+        """
+        Internal method.
+        Gets the connection for the current process. Creating it, and the tables, if needed.
+        """
+        if self._connection is None or self._connection_pid != os.getpid():
+            LOG.debug("Opening '%s'."%(self.filename))
+            connection = sqlite3.connect(self.filename, timeout=self._timeout_seconds, isolation_level=None)
+            try:
+                # Readers do not block the writer, and the other way around.
+                connection.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.DatabaseError, e:
+                LOG.warning("Could not use write ahead logging for '%s': %s"%(self.filename, str(e)))
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+            self._connection = connection
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Internal method.
+        Runs the enclosed statements in one transaction, holding the write lock from the start.
+        """
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def close(self):
+        """
+        Closes the connection of the current process.
+        """
+        if self._connection is not None and self._connection_pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+        self._connection_pid = None
+
+
+class ListingCache(_SqliteFile):
+    """
+    Persistent cache of the directory listings, stored in a local sqlite file.
+
+    The lines returned by the ftp server for LIST are stored per host, username and
+    path, together with the time they were fetched. Different logins on the same host
+    may see different trees, so they do not share listings. The username is "" when
+    logging in anonymously. The same file can be used by several
+    processes at the same time, and by several runs, e.g.:
+
+        cache = easy_ftp.ListingCache("/var/cache/ftp_listings.sqlite",
+                                      max_age_seconds = 3600,
+                                      policies = [("/archive/*", None)])
+        with easy_ftp.FTP("ftp://<ftp host name>/ftp/root/path", listing_cache = cache) as ftp:
+            files = ftp.get_file_names("/archive/2012")
+
+    max_age_seconds is the number of seconds a listing is considered fresh. None
+    means the listing never expires.
+
+    policies is a list of (pattern, max_age_seconds) pairs, overriding max_age_seconds
+    for some paths. The first pattern matching the path is used. The pattern is either
+    a shell like pattern (see fnmatch) or a function taking the path and returning
+    True if it matches. E.g. a function that checks if the date in a path is more than
+    30 days old, combined with None, makes the old directories immutable.
+
+    The cached listings are not used when checking file sizes, see FTP.get_file_size.
+    """
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS listings ("
+              "host TEXT NOT NULL, "
+              "username TEXT NOT NULL, "
+              "path TEXT NOT NULL, "
+              "fetched REAL NOT NULL, "
+              "lines BLOB NOT NULL, "
+              "PRIMARY KEY (host, username, path))",)
+
+    def __init__(self, filename, max_age_seconds = 3600, policies = None, timeout_seconds = 30):
+        assert(max_age_seconds == None or max_age_seconds >= 0)
+        _SqliteFile.__init__(self, filename, timeout_seconds = timeout_seconds)
+        self._max_age_seconds = max_age_seconds
+        self._policies = policies or []
+
+    def get_max_age_seconds(self, path):
+        """
+        Gets the number of seconds the listing of the path is fresh. None if it never expires.
+        """
+        for pattern, max_age_seconds in self._policies:
+            if callable(pattern):
+                matches = pattern(path)
+            else:
+                matches = fnmatch.fnmatchcase(path, pattern)
+            if matches:
+                return max_age_seconds
+        return self._max_age_seconds
+
+    def get(self, host, path, username = ""):
+        """
+        Gets the cached listing lines for the path on the host, as seen by the user.
+        None if the path has not been listed, or the listing is no longer fresh.
+        """
+        row = self._connect().execute("SELECT fetched, lines FROM listings WHERE host = ? AND username = ? AND path = ?",
+                                      (host, username, path)).fetchone()
+        if row is None:
+            LOG.debug("Listing cache: '%s%s' not cached."%(host, path))
+            return None
+        fetched, lines = row
+        max_age_seconds = self.get_max_age_seconds(path)
+        if max_age_seconds != None and time.time() - fetched > max_age_seconds:
+            LOG.debug("Listing cache: '%s%s' is %i second(s) old. Expired."%(host, path, time.time() - fetched))
+            return None
+        LOG.debug("Listing cache: Using cached listing of '%s%s'."%(host, path))
+        lines = str(lines)
+        if not lines:
+            return []
+        return lines.split("\n")
+
+    def put(self, host, path, lines, username = ""):
+        """
+        Stores the listing lines for the path on the host, as seen by the user.
+        """
+        with self._transaction() as connection:
+            connection.execute("INSERT OR REPLACE INTO listings (host, username, path, fetched, lines) VALUES (?, ?, ?, ?, ?)",
+                               (host, username, path, time.time(), sqlite3.Binary("\n".join(lines))))
+
+    def invalidate(self, host, path = None, username = None):
+        """
+        Removes the listing of the path on the host, or all the listings on the host if
+        path is not given. Only for the user, if username is given, else for all users.
+        """
+        query = "DELETE FROM listings WHERE host = ?"
+        arguments = [host]
+        if path != None:
+            query += " AND path = ?"
+            arguments.append(path)
+        if username != None:
+            query += " AND username = ?"
+            arguments.append(username)
+        with self._transaction() as connection:
+            connection.execute(query, arguments)
+
+
+class DownloadJob(object):
+    """
+    Object holding a download job from the DownloadQueue.
+    """
+    def __init__(self, job_id, remote_file_address, destination_filename, priority, deadline, state, bytes_done, attempts):
+        self.id = job_id
+        self.remote_file_address = remote_file_address
+        self.destination_filename = destination_filename
+        self.priority = priority
+        self.deadline = deadline
+        self.state = state
+        self.bytes_done = bytes_done
+        self.attempts = attempts
+
+    def __str__(self):
+        return "%i: '%s' -> '%s' (%s)"%(self.id, self.remote_file_address, self.destination_filename, self.state)
+
+
+class DownloadQueue(_SqliteFile):
+    """
+    Persistent queue of download jobs, stored in a local sqlite file.
+
+    Each job is pending, in flight, done, failed or expired. The number of bytes
+    downloaded so far is checkpointed while a job is in flight, so that the download
+    can be resumed after a crash, e.g.:
+
+        queue = easy_ftp.DownloadQueue("/var/lib/ftp_jobs.sqlite")
+        queue.add("/ftp/root/path/fish.txt", "/tmp/fish.txt", priority = 10)
+        easy_ftp.DownloadScheduler(queue, "ftp://<ftp host name>/ftp/root/path", number_of_workers = 4).run()
+
+    Adding a job that is already in the queue (same remote file and destination)
+    does nothing, so the same batch can be added again after a restart.
+
+    Pending jobs are taken by the highest priority first, then by the earliest
+    deadline. Pending jobs past their deadline are expired instead of downloaded.
+    """
+    PENDING = "pending"
+    IN_FLIGHT = "in_flight"
+    DONE = "done"
+    FAILED = "failed"
+    EXPIRED = "expired"
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS jobs ("
+              "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+              "remote_file_address TEXT NOT NULL, "
+              "destination_filename TEXT NOT NULL, "
+              "priority INTEGER NOT NULL DEFAULT 0, "
+              "deadline REAL, "
+              "state TEXT NOT NULL, "
+              "bytes_done INTEGER NOT NULL DEFAULT 0, "
+              "attempts INTEGER NOT NULL DEFAULT 0, "
+              "error TEXT, "
+              "updated REAL NOT NULL, "
+              "UNIQUE (remote_file_address, destination_filename))",
+              "CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, priority, deadline)")
+
+    def add(self, remote_file_address, destination_filename, priority = 0, deadline = None):
+        """
+        Adds a pending job. The deadline is in seconds since the epoch, see time.time().
+        Higher priorities are downloaded first.
+        """
+        with self._transaction() as connection:
+            connection.execute("INSERT OR IGNORE INTO jobs (remote_file_address, destination_filename, priority, deadline, state, updated) "
+                               "VALUES (?, ?, ?, ?, ?, ?)",
+                               (remote_file_address, destination_filename, priority, deadline, DownloadQueue.PENDING, time.time()))
+
+    def claim(self):
+        """
+        Takes the next pending job and marks it as in flight.
+        Returns None if there are no pending jobs.
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute("UPDATE jobs SET state = ?, updated = ? WHERE state = ? AND deadline IS NOT NULL AND deadline < ?",
+                               (DownloadQueue.EXPIRED, now, DownloadQueue.PENDING, now))
+            row = connection.execute("SELECT id, remote_file_address, destination_filename, priority, deadline, state, bytes_done, attempts "
+                                     "FROM jobs WHERE state = ? "
+                                     "ORDER BY priority DESC, deadline IS NULL, deadline, id LIMIT 1",
+                                     (DownloadQueue.PENDING,)).fetchone()
+            if row is None:
+                return None
+            job = DownloadJob(*row)
+            job.state = DownloadQueue.IN_FLIGHT
+            job.attempts += 1
+            connection.execute("UPDATE jobs SET state = ?, attempts = ?, updated = ? WHERE id = ?",
+                               (job.state, job.attempts, now, job.id))
+        LOG.debug("Download queue: Claimed %s."%(job))
+        return job
+
+    def checkpoint(self, job_id, bytes_done):
+        """
+        Records the number of bytes downloaded, and safely stored, so far.
+        """
+        with self._transaction() as connection:
+            connection.execute("UPDATE jobs SET bytes_done = ?, updated = ? WHERE id = ?", (bytes_done, time.time(), job_id))
+
+    def complete(self, job_id):
+        """
+        Marks the job as done.
+        """
+        with self._transaction() as connection:
+            connection.execute("UPDATE jobs SET state = ?, error = NULL, updated = ? WHERE id = ?", (DownloadQueue.DONE, time.time(), job_id))
+
+    def fail(self, job_id, error, max_attempts = 1):
+        """
+        Marks the job as failed. If it has been tried less than max_attempts times,
+        it is put back in the queue instead.
+        """
+        with self._transaction() as connection:
+            connection.execute("UPDATE jobs SET state = CASE WHEN attempts < ? THEN ? ELSE ? END, error = ?, updated = ? WHERE id = ?",
+                               (max_attempts, DownloadQueue.PENDING, DownloadQueue.FAILED, str(error), time.time(), job_id))
+
+    def recover(self):
+        """
+        Puts the jobs that were in flight back in the queue, e.g. after a crash.
+        The bytes already downloaded are kept. Returns the number of jobs recovered.
+
+        Only call this when no workers are using the queue, e.g. while holding the
+        scheduler lock, see DownloadScheduler.
+        """
+        with self._transaction() as connection:
+            cursor = connection.execute("UPDATE jobs SET state = ?, updated = ? WHERE state = ?",
+                                        (DownloadQueue.PENDING, time.time(), DownloadQueue.IN_FLIGHT))
+            number_of_jobs = cursor.rowcount
+        if number_of_jobs:
+            LOG.info("Download queue: %i job(s) in flight put back in the queue."%(number_of_jobs))
+        return number_of_jobs
+
+    def count(self):
+        """
+        Gets the number of jobs in each state.
+        """
+        counts = dict((state, 0) for state in (DownloadQueue.PENDING, DownloadQueue.IN_FLIGHT, DownloadQueue.DONE, DownloadQueue.FAILED, DownloadQueue.EXPIRED))
+        for state, number_of_jobs in self._connect().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"):
+            counts[state] = number_of_jobs
+        return counts
+
 
 class FTP:
     """
     The class that creates the ftp-connection.
     """
-    def __init__(self, ftp_remote_address, username=None, password=None, timeout_seconds=0, number_of_retries=0, cooldown_seconds = None):
+    def __init__(self, ftp_remote_address, username=None, password=None, timeout_seconds=0, number_of_retries=0, cooldown_seconds = None, listing_cache = None,
+                 tls = False, tls_protect_data = True, tls_verify = True, tls_context = None, tls_keyfile = None, tls_certfile = None):
         """
         The constructor of the ftp connection.
         Automatically logs in and changes the working directory to the ftp path.
+
+        If listing_cache, a ListingCache, is given, directory listings are read from
+        it when they are fresh, and stored in it when they are fetched from the server.
+
+        If tls is True, explicit TLS (FTPS, AUTH TLS) is used. The data connections are
+        protected (PROT P) if tls_protect_data is True, else they are in clear text (PROT C).
+        The certificate and hostname of the server are verified against the system CA
+        certificates, unless tls_verify is False. A client certificate can be given as
+        tls_certfile and tls_keyfile. Or everything can be set up in tls_context, an
+        ssl.SSLContext, in which case tls_verify, tls_certfile and tls_keyfile are not used.
+        Each protected data connection does a full TLS handshake, and PROT P fails against
+        servers requiring TLS session reuse, e.g. vsftpd by default, see _FTP_TLS.
         """
         # Making sure this is a positive number, or nothing at all.
         assert(number_of_retries >= 0 or number_of_retries == None)
         assert(timeout_seconds >= 0 or timeout_seconds == None)
+        if tls and not hasattr(ftplib, "FTP_TLS"):
+            raise EasyFtpError("TLS is not supported by this version of ftplib.")
+        if tls_context is not None and (tls_keyfile or tls_certfile):
+            raise EasyFtpError("Give the client certificate either in tls_context or as tls_keyfile and tls_certfile, not both.")
 
         # Setting up.
         # TODO: "root_path" is probably a incorrect name. Should be renamed to something a bit more appropriate.
@@ -186,6 +555,15 @@ class FTP:
         self._timeout_seconds = timeout_seconds
         self._cooldown_seconds = cooldown_seconds
         self._cooldown_timestamp = None
+        self._listing_cache = listing_cache
+        self._tls = tls
+        self._tls_protect_data = tls_protect_data
+        self._tls_verify = tls_verify
+        self._tls_context = tls_context
+        self._tls_keyfile = tls_keyfile
+        self._tls_certfile = tls_certfile
+        if tls and tls_context is None:
+            self._tls_context = self._create_tls_context()
         
         # Login.
         # Sets the ftp variable.
@@ -210,7 +588,7 @@ class FTP:
         @timeout(self._timeout_seconds + self._cooldown_get_seconds_since_last_timestamp())
         def _setup(self):
             LOG.debug("Setting up %s."%(self.host))
-            self.ftp = ftplib.FTP(self.host)
+            self.ftp = self._create_ftp()
             LOG.debug("Logging in to %s."%(self.host))
             self.login()
 
@@ -224,6 +602,30 @@ class FTP:
             _setup(self)
             
 
+    def _create_ftp(self):
+        """
+        Internal method.
+        Creates the ftplib connection. Using TLS if specified in the constructor.
+        """
+        if not self._tls:
+            return ftplib.FTP(self.host)
+        LOG.debug("Using explicit TLS for %s."%(self.host))
+        return _FTP_TLS(self.host, context = self._tls_context)
+
+    def _create_tls_context(self):
+        """
+        Internal method.
+        Creates the ssl context used for TLS. Verifying the server, unless told not to.
+        """
+        context = ssl.create_default_context()
+        if not self._tls_verify:
+            LOG.warning("TLS: The certificate of %s is not verified. The connection is not protected against man in the middle attacks."%(self.host))
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        if self._tls_certfile:
+            context.load_cert_chain(self._tls_certfile, self._tls_keyfile)
+        return context
+
     def _cooldown_get_seconds_since_last_timestamp(self):
         """
         Internal method.
@@ -287,7 +689,7 @@ class FTP:
                 if not hasattr(self, 'ftp') or not hasattr(self.ftp, 'socket'):
                     LOG.debug("No connection. Creating it.")
                     self._cooldown()
-                    self.ftp = ftplib.FTP(self.host)
+                    self.ftp = self._create_ftp()
                     self._cooldown_set_timestamp()
 
                 # Login
@@ -301,6 +703,15 @@ class FTP:
                     LOG.debug("Logging in to the ftp server, %s."%(self.host))
                     self.ftp.login()
 
+                # Securing the data connections. Must be done after login.
+                if self._tls:
+                    if self._tls_protect_data:
+                        LOG.debug("Protecting the data connections, PROT P.")
+                        self.ftp.prot_p()
+                    else:
+                        LOG.debug("Data connections in clear text, PROT C.")
+                        self.ftp.prot_c()
+
                 # We are now logged in.
                 LOG.debug("Logged in...")
                 LOG.info(self.ftp.getwelcome())
@@ -323,13 +734,17 @@ class FTP:
         LOG.debug("Logging in.")
         _login(self, LOG)
 
-    def get_file_size(self, remote_file_address, timeout_seconds = None):
+    def get_file_size(self, remote_file_address, timeout_seconds = None, use_cache = False):
         """
         Gets the remote file size.
+
+        The size is used to decide if a file must be downloaded, and if it was downloaded
+        correctly, so by default the directory is listed on the server, even if a listing
+        cache is used. The fresh listing is stored in the cache.
         """
         remote_dir = os.path.dirname(remote_file_address)
         basename = os.path.basename(remote_file_address)
-        for entry in self.get_entries(remote_dir, timeout_seconds = timeout_seconds):
+        for entry in self.get_entries(remote_dir, timeout_seconds = timeout_seconds, use_cache = use_cache):
             if entry.name == basename:
                 if entry.type == "-":
                     return entry.size
@@ -465,12 +880,14 @@ class FTP:
                 LOG.info("File '%s' already exists and has the same filesize as the remote file. Assuming nothing has happend. Returning."%(remote_file_address))
                 return True
         
-        try:
-            if download_using_urllib2(self, remote_file_address, destination_filename, LOG):
-                return True
-        except Exception, e:
-            LOG.error("Failed downloading using urllib2: %s"%(str(e)))
-            LOG.error("Will try with ftplib.")
+        # urllib2 does not support TLS. Going directly to ftplib.
+        if not self._tls:
+            try:
+                if download_using_urllib2(self, remote_file_address, destination_filename, LOG):
+                    return True
+            except Exception, e:
+                LOG.error("Failed downloading using urllib2: %s"%(str(e)))
+                LOG.error("Will try with ftplib.")
             
         # Commanding the work done!!!
         if not hasattr(self, 'ftp') or self.ftp == None:
@@ -503,6 +920,349 @@ class FTP:
         LOG.warning("*"*50)
         return False
 
+    def resume_download(self, remote_file_address, destination_filename, bytes_done = 0, checkpoint = None, checkpoint_bytes = 1048576, timeout_seconds = None):
+        """
+        Downloads a file, continuing from bytes_done (using REST) if the temporary
+        file, '<destination_filename>.tmp', already holds that many bytes.
+
+        If checkpoint is given, it is called with the number of bytes safely written
+        to the temporary file, at least every checkpoint_bytes bytes.
+
+        Retrying, from where the last attempt stopped, if specified in the initializer.
+        """
+        if not timeout_seconds:
+            timeout_seconds = self._timeout_seconds
+        assert(timeout_seconds >= 0)
+        destination_filename_tmp = "%s.tmp"%(destination_filename)
+        # Updated while downloading, so that a retry continues where the last attempt stopped.
+        progress = {"bytes_done": bytes_done}
+
+        @retry(self._number_of_retries)
+        @timeout(timeout_seconds + self._cooldown_get_seconds_since_last_timestamp())
+        def _resume_download(self, LOG):
+            # Never trust more bytes than are actually in the temporary file.
+            if os.path.isfile(destination_filename_tmp):
+                bytes_done = min(progress["bytes_done"], os.path.getsize(destination_filename_tmp))
+            else:
+                bytes_done = 0
+            progress["bytes_done"] = bytes_done
+
+            self._cooldown()
+            try:
+                with open(destination_filename_tmp, 'ab') as local_file:
+                    local_file.truncate(bytes_done)
+                    checkpointed = {"bytes_done": bytes_done}
+
+                    def write(data):
+                        local_file.write(data)
+                        progress["bytes_done"] += len(data)
+                        if checkpoint and progress["bytes_done"] - checkpointed["bytes_done"] >= checkpoint_bytes:
+                            local_file.flush()
+                            os.fsync(local_file.fileno())
+                            checkpoint(progress["bytes_done"])
+                            checkpointed["bytes_done"] = progress["bytes_done"]
+
+                    LOG.debug("Downloading '%s' from byte %i."%(remote_file_address, bytes_done))
+                    try:
+                        self.ftp.retrbinary("RETR %s"%(remote_file_address), write, rest = bytes_done or None)
+                    except ftplib.error_perm, e:
+                        if not bytes_done:
+                            raise e
+                        # Most likely, the server does not support REST.
+                        LOG.warning("Could not resume '%s' from byte %i: %s. Starting from the beginning."%(remote_file_address, bytes_done, str(e)))
+                        local_file.truncate(0)
+                        progress["bytes_done"] = checkpointed["bytes_done"] = 0
+                        self.ftp.retrbinary("RETR %s"%(remote_file_address), write)
+                    local_file.flush()
+                    os.fsync(local_file.fileno())
+                    if checkpoint:
+                        checkpoint(progress["bytes_done"])
+                    return progress["bytes_done"]
+            finally:
+                self._cooldown_set_timestamp()
+
+        # Commanding the work done.
+        if not hasattr(self, 'ftp') or self.ftp == None:
+            self.setup()
+
+        local_file_size = _resume_download(self, LOG)
+        try:
+            remote_file_size = self.ftp.size(remote_file_address)
+        except ftplib.error_perm, e:
+            LOG.debug("SIZE failed: %s. Using LIST."%(str(e)))
+            remote_file_size = self.get_file_size(remote_file_address)
+        if local_file_size == remote_file_size:
+            LOG.debug("Moving '%s' to '%s'."%(destination_filename_tmp, destination_filename))
+            shutil.move(destination_filename_tmp, destination_filename)
+            LOG.info("File '%s' saved."%(destination_filename))
+            return True
+        LOG.error("Filesize does not match. Remote: %s. Local: %s"%(remote_file_size, local_file_size))
+        # Starting from scratch next time.
+        os.remove(destination_filename_tmp)
+        if checkpoint:
+            checkpoint(0)
+        return False
+
+    def download_files(self, files, timeout_seconds=None, pipeline=True, window_size=50):
+        """
+        Downloads many (small) files on the one control connection.
+
+        files is a list of (remote_file_address, destination_filename) pairs.
+
+        Instead of waiting for each reply before sending the next command, the
+        commands are pipelined:
+        - The SIZE commands are sent window_size at a time, before the replies are read.
+          The sizes are used both for skipping existing files and for verifying
+          the downloaded files, so no LIST is needed.
+        - If pipeline is True, the PASV for the next file is sent as soon as the current
+          transfer has started, so the next data connection is ready when the transfer
+          finishes.
+
+        Sending PASV during a transfer requires a server that queues the commands it
+        gets during a transfer, and answers them after the transfer is completed.
+        RFC 959 does not require this, and some servers abort the transfer instead. Set
+        pipeline to False for such servers. If the server answers the PASV before the
+        transfer is completed, or a file sent while the next PASV was waiting does not
+        have the right size, pipelining is turned off for the rest of the files, and
+        that file is downloaded again using download_file.
+
+        If something goes wrong with the control connection, it logs in again and
+        downloads the rest of the files one by one, using download_file.
+
+        The timeout is per file, and per window of SIZE commands. Returns a TransferReport.
+        """
+        if not timeout_seconds:
+            timeout_seconds = self._timeout_seconds
+        assert(timeout_seconds >= 0)
+        assert(window_size >= 1)
+
+        report = TransferReport()
+        start_time = time.time()
+
+        # Internal method. Gets the sizes of some files, with the SIZE commands pipelined.
+        @timeout(timeout_seconds)
+        def get_sizes(self, remote_file_addresses, LOG):
+            """
+            Sends SIZE for all the files before reading the replies.
+            Returns the sizes. None for the files the server did not give the size of.
+            """
+            for remote_file_address in remote_file_addresses:
+                self.ftp.putcmd("SIZE %s"%(remote_file_address))
+            sizes = []
+            for remote_file_address in remote_file_addresses:
+                try:
+                    reply = self.ftp.getresp()
+                    sizes.append(long(reply[3:].strip()))
+                except ftplib.error_perm, e:
+                    # SIZE is not supported, or the file does not exist. Verified using LIST later on.
+                    LOG.debug("Pipelined: No size for '%s': %s"%(remote_file_address, str(e)))
+                    sizes.append(None)
+            return sizes
+
+        # Internal method. Handles the replies for one file, while the next file is being requested.
+        @timeout(timeout_seconds)
+        def transfer(self, remote_file_address, destination_filename_tmp, pasv_reply, send_next_pasv, LOG):
+            """
+            Reads the reply to the already sent PASV (or EPSV), connects, and retrieves
+            the file to destination_filename_tmp.
+            Returns the number of bytes, the reply to the next PASV, if it has been read,
+            and if the server answered the next PASV before the transfer was completed.
+            The number of bytes is None if the server refused to send the file.
+            """
+            if pasv_reply == None:
+                pasv_reply = self.ftp.getresp()
+            data_address = self._parse_pasv_reply(pasv_reply)
+
+            LOG.debug("Pipelined: Retrieving '%s'."%(remote_file_address))
+            conn = socket.create_connection(data_address, self.ftp.timeout)
+            try:
+                self.ftp.putcmd("RETR %s"%(remote_file_address))
+                try:
+                    reply = self.ftp.getresp()
+                except ftplib.error_perm, e:
+                    # E.g. the file does not exist. The next PASV has not been sent.
+                    LOG.error("Failed downloading '%s': %s"%(remote_file_address, str(e)))
+                    return None, None, False
+                if reply[0] != "1":
+                    raise ftplib.error_reply(reply)
+                if hasattr(self.ftp, "wrap_data_socket"):
+                    conn = self.ftp.wrap_data_socket(conn)
+
+                # The transfer has started. Asking for the next data connection.
+                if send_next_pasv:
+                    self.ftp.putcmd(self._get_pasv_command())
+
+                number_of_bytes = 0
+                with open(destination_filename_tmp, 'wb') as local_file:
+                    while True:
+                        data = conn.recv(65536)
+                        if not data:
+                            break
+                        local_file.write(data)
+                        number_of_bytes += len(data)
+                if isinstance(conn, ssl.SSLSocket):
+                    conn.unwrap()
+            finally:
+                conn.close()
+
+            # Some servers reply to the next PASV before the transfer is completed.
+            next_pasv_reply = None
+            out_of_order = False
+            reply = self.ftp.getresp()
+            if send_next_pasv and reply[:3] in ("227", "229"):
+                LOG.warning("Pipelined: The server answered PASV during the transfer of '%s'."%(remote_file_address))
+                next_pasv_reply = reply
+                out_of_order = True
+                reply = self.ftp.getresp()
+            if reply[0] != "2":
+                raise ftplib.error_reply(reply)
+            return number_of_bytes, next_pasv_reply, out_of_order
+
+        # Commanding the work done.
+        # NOTE: Listing the contents (get_file_size) logs in again, so the paths given to get_file_size
+        # are made absolute, using the root path.
+        if not hasattr(self, 'ftp') or self.ftp == None:
+            self.setup()
+
+        remote_file_sizes = {}
+        files_to_download = []
+        unverified = []
+        download_again = []
+        remaining = list(files)
+        try:
+            self._cooldown()
+            self.ftp.voidcmd("TYPE I")
+
+            # Pipelined SIZE commands. A window at a time, so that the replies do not fill up the buffers.
+            remote_file_addresses = [remote_file_address for remote_file_address, destination_filename in files]
+            for start in range(0, len(remote_file_addresses), window_size):
+                window = remote_file_addresses[start:start + window_size]
+                remote_file_sizes.update(zip(window, get_sizes(self, window, LOG)))
+
+            for remote_file_address, destination_filename in files:
+                if os.path.isfile(destination_filename):
+                    remote_file_size = remote_file_sizes[remote_file_address]
+                    if remote_file_size == None:
+                        remote_file_size = self.get_file_size(os.path.join(self.root_path, remote_file_address))
+                    if remote_file_size == os.path.getsize(destination_filename):
+                        LOG.info("File '%s' already exists and has the same filesize as the remote file. Skipping."%(remote_file_address))
+                        report.skipped.append(remote_file_address)
+                        continue
+                files_to_download.append((remote_file_address, destination_filename))
+            remaining = list(files_to_download)
+
+            # The LIST above, if any, switched to ASCII, and logged in again, leaving the root path.
+            self.ftp.voidcmd("TYPE I")
+            self.ftp.cwd(self.root_path)
+
+            # Pipelined transfers.
+            pasv_sent = False
+            pasv_reply = None
+            for index, (remote_file_address, destination_filename) in enumerate(files_to_download):
+                destination_filename_tmp = "%s.tmp"%(destination_filename)
+                if not pasv_sent:
+                    self._cooldown()
+                    self.ftp.putcmd(self._get_pasv_command())
+                send_next_pasv = pipeline and index + 1 < len(files_to_download) and not self._cooldown_seconds
+                try:
+                    number_of_bytes, pasv_reply, out_of_order = transfer(self, remote_file_address, destination_filename_tmp, pasv_reply, send_next_pasv, LOG)
+                finally:
+                    self._cooldown_set_timestamp()
+                remaining.pop(0)
+                if number_of_bytes == None:
+                    report.failed.append(remote_file_address)
+                    pasv_sent = False
+                    continue
+                pasv_sent = send_next_pasv
+                if out_of_order:
+                    # The server does not queue the commands during a transfer. Not taking any chances.
+                    LOG.warning("Pipelined: Turning off pipelining of PASV.")
+                    pipeline = False
+
+                remote_file_size = remote_file_sizes[remote_file_address]
+                if remote_file_size == None:
+                    # Can not verify using LIST in the middle of the pipeline.
+                    unverified.append((remote_file_address, destination_filename, number_of_bytes))
+                elif number_of_bytes == remote_file_size:
+                    shutil.move(destination_filename_tmp, destination_filename)
+                    report.succeeded.append(remote_file_address)
+                    report.number_of_bytes += number_of_bytes
+                elif send_next_pasv:
+                    # The transfer may have been cut short by the PASV sent during the transfer.
+                    LOG.warning("Pipelined: Filesize of '%s' does not match. Remote: %s. Local: %s. Turning off pipelining of PASV, and downloading it again."%(remote_file_address, remote_file_size, number_of_bytes))
+                    pipeline = False
+                    download_again.append((remote_file_address, destination_filename))
+                else:
+                    LOG.error("Filesize does not match. Remote: %s. Local: %s"%(remote_file_size, number_of_bytes))
+                    report.failed.append(remote_file_address)
+        except Exception, e:
+            # The state of the control connection is unknown. Starting over with a new one.
+            LOG.error("Pipelined downloading failed: %s"%(str(e)))
+            if remaining:
+                LOG.error("Logging in again, and downloading the remaining %i file(s) one by one."%(len(remaining)))
+                try:
+                    self.login()
+                    self.ftp.cwd(self.root_path)
+                    download_again.extend(remaining)
+                except Exception, e:
+                    LOG.error("Could not log in again: %s"%(str(e)))
+                    report.failed.extend(remote_file_address for remote_file_address, destination_filename in remaining)
+
+        # Downloading the files that could not be downloaded in the pipeline, one by one.
+        for remote_file_address, destination_filename in download_again:
+            # download_file checks the size using LIST, see above.
+            remote_file_path = os.path.join(self.root_path, remote_file_address)
+            if self.download_file(remote_file_path, destination_filename, timeout_seconds=timeout_seconds):
+                report.succeeded.append(remote_file_address)
+                report.number_of_bytes += os.path.getsize(destination_filename)
+            else:
+                report.failed.append(remote_file_address)
+
+        # Verifying the files the server did not give the size of.
+        for remote_file_address, destination_filename, number_of_bytes in unverified:
+            destination_filename_tmp = "%s.tmp"%(destination_filename)
+            try:
+                remote_file_size = self.get_file_size(os.path.join(self.root_path, remote_file_address))
+            except Exception, e:
+                LOG.error(e)
+                remote_file_size = None
+            if number_of_bytes == remote_file_size:
+                shutil.move(destination_filename_tmp, destination_filename)
+                report.succeeded.append(remote_file_address)
+                report.number_of_bytes += number_of_bytes
+            else:
+                LOG.error("Filesize does not match. Remote: %s. Local: %s"%(remote_file_size, number_of_bytes))
+                report.failed.append(remote_file_address)
+
+        # Listing the contents logs in again. Making sure the caller is left in the root path.
+        if unverified or download_again:
+            try:
+                self.ftp.cwd(self.root_path)
+            except ftplib.all_errors, e:
+                LOG.warning("Could not change back to the root path, '%s': %s"%(self.root_path, str(e)))
+
+        report.seconds = time.time() - start_time
+        LOG.info("Pipelined: %s"%(report))
+        return report
+
+    def _get_pasv_command(self):
+        """
+        Internal method.
+        Gets the command for a passive data connection. EPSV for IPv6, else PASV.
+        """
+        if self.ftp.af == socket.AF_INET:
+            return "PASV"
+        return "EPSV"
+
+    def _parse_pasv_reply(self, reply):
+        """
+        Internal method.
+        Gets the (host, port) of the data connection from the reply to PASV or EPSV.
+        """
+        if self.ftp.af == socket.AF_INET:
+            return ftplib.parse227(reply)
+        return ftplib.parse229(reply, self.ftp.sock.getpeername())
+
     @staticmethod
     def split_ftp_host_and_path(ftp_remote_address):
         """
@@ -599,26 +1359,30 @@ class FTP:
         """
         return [ os.path.join(x.remote_dir, x.name) for x in self.get_entries(path, timeout_seconds = timeout_seconds) if x.type == "l"]
 
-    def get_entries(self, path = None, timeout_seconds = None):
+    def get_entries(self, path = None, timeout_seconds = None, use_cache = True):
         """
         Parses the list content string and returns a list of all the entries starting with
         "startswith".
 
         If path is not set, remote current working directory is used.
+        If use_cache is False, the listing cache is not read, see list_contents.
         """
         entries = []
-        content_lines, remote_path = self.list_contents(path, timeout_seconds=timeout_seconds)
+        content_lines, remote_path = self.list_contents(path, timeout_seconds=timeout_seconds, use_cache=use_cache)
         LOG.debug("Ftp-content:")
         for content_line in content_lines:
             if content_line[0] in ["-", "d", "l"]: # File, directory, link.
                 entries.append(FtpEntry(content_line, remote_path))
         return entries
 
-    def list_contents(self, remote_path=None, timeout_seconds = None):
+    def list_contents(self, remote_path=None, timeout_seconds = None, use_cache = True):
         """
         Lists the contents for a given path.
         When the contents has been listed, the working directory is 
         Retries once if an error occurs.
+
+        If use_cache is False, the path is listed on the server even if a fresh listing
+        is in the listing cache. The new listing is still stored in the cache.
         """
         if not timeout_seconds:
             timeout_seconds = self._timeout_seconds
@@ -630,7 +1394,8 @@ class FTP:
             Changes the directory to the remote_path, if given, and list all the contents in that directory. Then automatically
             changes the working directory back to the ftp address root.
             
-            Returns a list of lines that the ftp server returns.
+            Returns a list of lines that the ftp server returns, the path and, if a listing
+            cache is used, the absolute path of the directory the server listed.
             """
             prev_remote_working_dir = self.ftp.pwd()
             if remote_path == None:
@@ -649,9 +1414,13 @@ class FTP:
 
                     LOG.debug("Changing path to %s"%(remote_path))
                     self.ftp.cwd(remote_path)
+                # Relative paths are relative to the directory after login, so asking the server.
+                listed_dir = None
+                if self._listing_cache is not None:
+                    listed_dir = self.ftp.pwd()
                 contents = []
                 self.ftp.retrlines("LIST", contents.append)
-                return contents, remote_path
+                return contents, remote_path, listed_dir
             finally:
                 if prev_remote_working_dir != None:
                     LOG.debug("Changing back to previous working dir: '%s'."%(prev_remote_working_dir))
@@ -659,9 +1428,23 @@ class FTP:
                 self._cooldown_set_timestamp()
 
 
+        # Using the cached listing, if it is fresh.
+        if self._listing_cache is not None and use_cache:
+            cache_path = self._get_listing_cache_path(remote_path)
+            if cache_path != None:
+                try:
+                    content_lines = self._listing_cache.get(self.host, cache_path, username = self.username or "")
+                except sqlite3.Error, e:
+                    LOG.warning("Listing cache: Could not read the listing of '%s': %s. Listing it on the server."%(cache_path, str(e)))
+                    content_lines = None
+                if content_lines is not None:
+                    if remote_path == None:
+                        return content_lines, cache_path
+                    return content_lines, remote_path
+
         # Calling the internal method.
         try:
-            return _list_contents(self, remote_path)
+            content_lines, listed_path, listed_dir = _list_contents(self, remote_path)
         except socket.error, e:
             # Most likely (by experience) because the session has timed out, or something alike.
             # The solution seem to be to relogin.
@@ -670,12 +1453,150 @@ class FTP:
             LOG.error("Trying to log in again.")
             self.login()
             LOG.error("Trying to list contents again.")
-            return _list_contents(self, remote_path)
+            content_lines, listed_path, listed_dir = _list_contents(self, remote_path)
+
+        # Storing the listing under the directory the server actually listed.
+        if self._listing_cache is not None and listed_dir:
+            try:
+                self._listing_cache.put(self.host, os.path.normpath(listed_dir), content_lines, username = self.username or "")
+            except sqlite3.Error, e:
+                LOG.warning("Listing cache: Could not store the listing of '%s': %s."%(listed_dir, str(e)))
+        return content_lines, listed_path
+
+    def _get_listing_cache_path(self, remote_path):
+        """
+        Internal method.
+        Gets the absolute, normalized path used as key in the listing cache.
+        None if it is not known which directory the server would list, i.e. for relative
+        paths, which are relative to the directory after login. These are listed on the
+        server, and stored under the directory listed.
+        """
+        if remote_path == None:
+            try:
+                remote_path = self.ftp.pwd()
+            except ftplib.all_errors, e:
+                LOG.debug("Listing cache: Could not get the working directory: %s"%(str(e)))
+                return None
+        if not remote_path.startswith("/"):
+            return None
+        return os.path.normpath(remote_path)
 
 
 
         
 
+class DownloadScheduler(object):
+    """
+    Runs the jobs in a DownloadQueue, using one or more FTP workers.
+
+    Each worker runs in its own process, with its own ftp connection, and takes
+    jobs from the queue until it is empty. The progress of each download is
+    checkpointed in the queue, so if the program dies, running the scheduler again
+    continues where it stopped. Jobs that are done are not checked again.
+
+    Only one scheduler can run on a queue at a time. It holds an exclusive lock on
+    '<queue filename>.lock' while running, so that it can safely put the jobs left in
+    flight by a crashed scheduler back in the queue. Starting a second scheduler on the
+    same queue raises an EasyFtpError. Jobs can still be added by other processes.
+
+    If a download fails, the worker logs in again before taking the next job. If it
+    can not log in, it waits and tries again, and stops after max_attempts tries.
+
+    The ftp_kwargs are given to the FTP constructor of each worker.
+    """
+    def __init__(self, queue, ftp_remote_address, number_of_workers = 1, max_attempts = 3, checkpoint_bytes = 1048576, login_sleep_seconds = 60, **ftp_kwargs):
+        assert(number_of_workers >= 1)
+        assert(max_attempts >= 1)
+        self.queue = queue
+        self.ftp_remote_address = ftp_remote_address
+        self._number_of_workers = number_of_workers
+        self._max_attempts = max_attempts
+        self._checkpoint_bytes = checkpoint_bytes
+        self._login_sleep_seconds = login_sleep_seconds
+        self._ftp_kwargs = ftp_kwargs
+
+    def run(self):
+        """
+        Runs the jobs until the queue has no pending jobs.
+        Returns the number of jobs in each state, see DownloadQueue.count.
+        """
+        # Only available on unix. Imported here, so that the rest of the module works without it.
+        import fcntl
+
+        lock_filename = "%s.lock"%(self.queue.filename)
+        with open(lock_filename, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    raise EasyFtpError("Another scheduler is running on '%s'."%(self.queue.filename))
+                raise e
+
+            # No other scheduler is running, so the jobs in flight were left by a crash.
+            self.queue.recover()
+            if self._number_of_workers == 1:
+                self._work()
+            else:
+                workers = [multiprocessing.Process(target = self._work) for i in range(self._number_of_workers)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+        counts = self.queue.count()
+        LOG.info("Download scheduler: %s"%(counts))
+        return counts
+
+    def _work(self):
+        """
+        Internal method.
+        The worker. Downloads the jobs from the queue, one by one.
+        """
+        with FTP(self.ftp_remote_address, **self._ftp_kwargs) as ftp:
+            while True:
+                job = self.queue.claim()
+                if job is None:
+                    LOG.debug("Download scheduler: No more pending jobs.")
+                    return
+
+                def checkpoint(bytes_done):
+                    self.queue.checkpoint(job.id, bytes_done)
+
+                try:
+                    if ftp.resume_download(job.remote_file_address, job.destination_filename, job.bytes_done,
+                                           checkpoint = checkpoint, checkpoint_bytes = self._checkpoint_bytes):
+                        self.queue.complete(job.id)
+                        continue
+                    error = "Filesize does not match."
+                except Exception, e:
+                    LOG.error(e)
+                    error = e
+                LOG.error("Download scheduler: Failed downloading %s: %s"%(job, str(error)))
+                self.queue.fail(job.id, error, max_attempts = self._max_attempts)
+
+                # E.g. a timeout in the middle of a transfer leaves unread replies on the
+                # control connection. Starting over with a new one.
+                if not self._relogin(ftp):
+                    LOG.error("Download scheduler: Could not log in again. Stopping the worker.")
+                    return
+
+    def _relogin(self, ftp):
+        """
+        Internal method.
+        Logs in again, and changes to the root path. Sleeping longer and longer between
+        the tries. Returns False if it failed max_attempts times.
+        """
+        for attempt in range(1, self._max_attempts + 1):
+            try:
+                ftp.login()
+                ftp.ftp.cwd(ftp.root_path)
+                return True
+            except Exception, e:
+                LOG.error("Download scheduler: Login failed (%i/%i): %s"%(attempt, self._max_attempts, str(e)))
+                if attempt < self._max_attempts:
+                    time.sleep(self._login_sleep_seconds * attempt)
+        return False
+
+
 if __name__ == "__main__":
     try:
         import argparse
@@ -701,6 +1622,9 @@ if __name__ == "__main__":
     group.add_argument('-d', '--debug', action='store_true', help="Output debugging information.")
     group.add_argument('-v', '--verbose', action='store_true', help="Output info.")
     parser.add_argument('--log-filename', type=str, help="File used to output logging information.")
+    parser.add_argument('--tls', action='store_true', help="Use explicit TLS (FTPS).")
+    parser.add_argument('--tls-clear-data', action='store_true', help="Do not protect the data connections when using TLS (PROT C).")
+    parser.add_argument('--tls-no-verify', action='store_true', help="Do not verify the certificate of the server when using TLS.")
     args = parser.parse_args()
 
     if args.debug:
@@ -716,7 +1640,7 @@ if __name__ == "__main__":
     # Output what is in the args variable.
     LOG.debug(args)
 
-    with FTP(args.remote_source_address, args.username, args.password) as ftp:
+    with FTP(args.remote_source_address, args.username, args.password, tls=args.tls, tls_protect_data=not args.tls_clear_data, tls_verify=not args.tls_no_verify) as ftp:
         directories = ftp.get_directory_names()
         files = ftp.get_file_names()
         links = ftp.get_link_names()